@@ -1,9 +1,63 @@
 """MicroPython module to connect ESP8266 to Raspberry Pi Pico"""
 
 from machine import UART
-from utime import sleep_ms
+from utime import ticks_ms, ticks_add, ticks_diff
+import uselect
+import ure
 from binascii import b2a_base64 as base64enc
 
+# Authentication modes reported from scan in field 'ecn', indexed by its value
+_ECNS = ("open", "WEP", "WPA-PSK", "WPA2-PSK", "WPA/WPA2-PSK")
+
+# +CWJAP_CUR:"<ssid>","<bssid>",<channel>,<rssi>
+_CWJAP_RE = ure.compile(r'\+CWJAP_(CUR|DEF):"([^"]*)","([^"]*)",(\d+),(-?\d+)')
+
+# Largest piece of data handed to a single UART write
+_TX_CHUNK = 512
+
+# Prefixes of the response lines, kept as bytes so lines can be matched without decoding
+_AT_VERSION = b'AT version:'
+_SDK_VERSION = b'SDK version:'
+_COMPILE_TIME = b'compile time:'
+_SLEEP = b'+SLEEP:'
+_CWMODE_CUR = b'+CWMODE_CUR:'
+_CWMODE_DEF = b'+CWMODE_DEF:'
+_CWJAP_CUR = b'+CWJAP_CUR:'
+_CWJAP_DEF = b'+CWJAP_DEF:'
+_CIPAPMAC_CUR = b'+CIPAPMAC_CUR:'
+_CIPSTAMAC_CUR = b'+CIPSTAMAC_CUR:'
+_CIPAP_CUR_IP = b'+CIPAP_CUR:ip:"'
+_CIPAP_CUR_GATEWAY = b'+CIPAP_CUR:gateway:"'
+_CIPAP_CUR_NETMASK = b'+CIPAP_CUR:netmask:"'
+_CIPSTA_CUR_IP = b'+CIPSTA_CUR:ip:"'
+_CIPSTA_CUR_GATEWAY = b'+CIPSTA_CUR:gateway:"'
+_CIPSTA_CUR_NETMASK = b'+CIPSTA_CUR:netmask:"'
+_CWSAP_CUR = b'+CWSAP_CUR:'
+_CWSAP_DEF = b'+CWSAP_DEF:'
+
+# AT commands without arguments
+_CMD_TEST = b'AT'
+_CMD_ATE0 = b'ATE0'
+_CMD_ATE1 = b'ATE1'
+_CMD_RST = b'AT+RST'
+_CMD_RESTORE = b'AT+RESTORE'
+_CMD_GMR = b'AT+GMR'
+_CMD_SLEEP_Q = b'AT+SLEEP?'
+_CMD_CWMODE_CUR_Q = b'AT+CWMODE_CUR?'
+_CMD_CWMODE_DEF_Q = b'AT+CWMODE_DEF?'
+_CMD_CWQAP = b'AT+CWQAP'
+_CMD_CWJAP_CUR_Q = b'AT+CWJAP_CUR?'
+_CMD_CWJAP_DEF_Q = b'AT+CWJAP_DEF?'
+_CMD_CWLAP = b'AT+CWLAP'
+_CMD_CIPAPMAC_CUR_Q = b'AT+CIPAPMAC_CUR?'
+_CMD_CIPSTAMAC_CUR_Q = b'AT+CIPSTAMAC_CUR?'
+_CMD_CIPAP_CUR_Q = b'AT+CIPAP_CUR?'
+_CMD_CIPSTA_CUR_Q = b'AT+CIPSTA_CUR?'
+_CMD_CWSAP_CUR_Q = b'AT+CWSAP_CUR?'
+_CMD_CWSAP_DEF_Q = b'AT+CWSAP_DEF?'
+_CMD_CIPSERVER_STOP = b'AT+CIPSERVER=0'
+_CMD_CIPCLOSE = b'AT+CIPCLOSE'
+
 class ESP8266:
 
     def __init__(self, uartPort: int, baudrate: int=115200, debug: bool=False) -> None:
@@ -15,6 +69,21 @@ class ESP8266:
         """
         self.uart = UartTimeOut(uartPort, baudrate=baudrate, txbuf=1024, rxbuf=2048)
         self.debug = debug
+        # wakes _exec as soon as the ESP8266 answers
+        self._poll = uselect.poll()
+        self._poll.register(self.uart, uselect.POLLIN)
+        # wakes _writeAll as soon as there is room in the UART TX buffer
+        self._poll_out = uselect.poll()
+        self._poll_out.register(self.uart, uselect.POLLOUT)
+        # receive buffer reused by every command; grown when a response does not fit
+        self._rxbuf = bytearray(512)
+        self._rxview = memoryview(self._rxbuf)
+        # bytes received after the awaited response line, kept for the next read
+        self._rxlen = 0
+        # last scan() result, the time it was taken and the filters it was made with
+        self._scan_cache = None
+        self._scan_cache_ts = 0
+        self._scan_cache_args = None
 
     #
     # BASIC COMMANDS
@@ -22,49 +91,46 @@ class ESP8266:
     #
     def test(self, debug=None):
         """Test the AT command interface"""
-        response, ok = self._exec('AT', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_TEST, b'OK', debug=debug)
         return ok
 
     def echoOff(self, debug=None):
         """AT commands echoing set to OFF"""
-        response, ok = self._exec('ATE0', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_ATE0, b'OK', debug=debug)
         return ok
 
     def echoOn(self, debug=None):
         """AT commands echoing set to ON"""
-        response, ok = self._exec('ATE1', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_ATE1, b'OK', debug=debug)
         return ok
 
     def restart(self, debug=None):
         """Restarts the module """
-        response, ok = self._exec('AT+RST', b'ready', timeout=10000, debug=debug)
+        response, ok = self._exec(_CMD_RST, b'ready', timeout=10000, debug=debug)
         return ok
 
     def factoryReset(self, debug=None):
         """Restores the factory default settings"""
-        response, ok = self._exec('AT+RESTORE', b'ready', timeout=10000, debug=debug)
+        response, ok = self._exec(_CMD_RESTORE, b'ready', timeout=10000, debug=debug)
         return ok
 
     def version(self, debug=None):
         """Checks ESP8266 version information
         Returns dictionary with 'AT version', 'SDK version' and 'compile time'
         """
-        response, ok = self._exec('AT+GMR', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_GMR, b'OK', debug=debug)
         if (not ok):
             return None
 
-        if (type(response) is not list):
-            return None
-
         ret = {}
         for line in response:
-            line = line.decode('utf-8').replace('\r', '').replace('\n', '')
-            if (line.find('AT version:') == 0):
-                ret["AT version"] = line.split(":", 1)[1]
-            if (line.find('SDK version:') == 0):
-                ret['SDK version'] = line.split(":", 1)[1]
-            if (line.find('compile time:') == 0):
-                ret['compile time'] = line.split(":", 1)[1]
+            line = line.rstrip()
+            if (line.startswith(_AT_VERSION)):
+                ret["AT version"] = line[len(_AT_VERSION):].decode('utf-8')
+            elif (line.startswith(_SDK_VERSION)):
+                ret['SDK version'] = line[len(_SDK_VERSION):].decode('utf-8')
+            elif (line.startswith(_COMPILE_TIME)):
+                ret['compile time'] = line[len(_COMPILE_TIME):].decode('utf-8')
 
         return ret
 
@@ -74,11 +140,10 @@ class ESP8266:
             1: Light-sleep mode
             2: Modem-sleep mode
         """
-        response, ok = self._exec('AT+SLEEP?', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_SLEEP_Q, b'OK', debug=debug)
         for line in response:
-            line = line.decode('utf-8').replace('\r', '').replace('\n', '')
-            if (line.find('+SLEEP:') == 0):
-                return int(line.split(':')[1])
+            if (line.startswith(_SLEEP)):
+                return int(line[len(_SLEEP):])
 
     def setSleepMode(self, mode, debug=None):
         """Configures the Sleep Modes. This command can only be used in Station mode. Modem-sleep (2) is the default sleep mode.
@@ -86,7 +151,7 @@ class ESP8266:
             1: Light-sleep mode
             2: Modem-sleep mode
         """
-        response, ok = self._exec('AT+SLEEP=' + str(mode), b'OK', debug=debug)
+        response, ok = self._exec(b'AT+SLEEP=%d' % mode, b'OK', debug=debug)
         return ok
 
     #
@@ -94,156 +159,206 @@ class ESP8266:
     #
     def getMode(self, debug=None):
         """Gets the Wi-Fi mode (Station/SoftAP/Station+SoftAP)"""
-        response, ok = self._exec('AT+CWMODE_CUR?', b'OK', debug=debug)
-        return self._parseMode(ok, response, '+CWMODE_CUR:', debug=debug)
+        response, ok = self._exec(_CMD_CWMODE_CUR_Q, b'OK', debug=debug)
+        return self._parseMode(ok, response, _CWMODE_CUR, debug=debug)
 
     def getDefaultMode(self, debug=None):
         """Gets the Wi-Fi Mode (Station/SoftAP/Station+SoftAP)"""
-        response, ok = self._exec('AT+CWMODE_DEF?', b'OK', debug=debug)
-        return self._parseMode(ok, response, '+CWMODE_DEF:', debug=debug)
+        response, ok = self._exec(_CMD_CWMODE_DEF_Q, b'OK', debug=debug)
+        return self._parseMode(ok, response, _CWMODE_DEF, debug=debug)
 
     def _parseMode(self, ok, response, q, debug=None):
         if (not ok):
             return None
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8')
-                if (line.find(q) == 0):
-                    return int(line.split(':')[1])
+        for line in response:
+            if (line.startswith(q)):
+                return int(line[len(q):])
 
     def setMode(self, mode, debug=None):
         """Sets the Wi-Fi Mode (Station/SoftAP/Station+SoftAP)"""
-        response, ok = self._exec('AT+CWMODE_CUR='+str(mode), b'OK', debug=debug)
+        response, ok = self._exec(b'AT+CWMODE_CUR=%d' % mode, b'OK', debug=debug)
         return ok
 
     def setDefaultMode(self, mode, debug=None):
         """Sets the Wi-Fi Mode (Station/SoftAP/Station+SoftAP)"""
-        response, ok = self._exec('AT+CWMODE_DEF='+str(mode), b'OK', debug=debug)
+        response, ok = self._exec(b'AT+CWMODE_DEF=%d' % mode, b'OK', debug=debug)
         return ok
 
     def connect(self, ssid, password, bssid=None, timeout=10000, debug=None):
         """Tries to connect to an AP"""
-        response, ok = self._exec('AT+CWJAP_CUR=' + self._joinArgs(ssid, password, bssid), b'OK', timeout=timeout, debug=debug)
+        if (bssid is None):
+            cmd = 'AT+CWJAP_CUR="%s","%s"' % (ssid, password)
+        else:
+            cmd = 'AT+CWJAP_CUR="%s","%s","%s"' % (ssid, password, bssid)
+        response, ok = self._exec(cmd, b'OK', timeout=timeout, debug=debug)
         return ok
 
     def connectDefault(self, ssid, password, bssid=None, timeout=10000, debug=None):
         """Tries to connect to an AP and saves configuration in the flash"""
-        response, ok = self._exec('AT+CWJAP_DEF=' + self._joinArgs(ssid, password, bssid), b'OK', timeout=timeout, debug=debug)
+        if (bssid is None):
+            cmd = 'AT+CWJAP_DEF="%s","%s"' % (ssid, password)
+        else:
+            cmd = 'AT+CWJAP_DEF="%s","%s","%s"' % (ssid, password, bssid)
+        response, ok = self._exec(cmd, b'OK', timeout=timeout, debug=debug)
         return ok
 
     def disconnect(self, debug=None):
-        response, ok = self._exec('AT+CWQAP', b'WIFI DISCONNECT', timeout=1000, debug=debug)
+        response, ok = self._exec(_CMD_CWQAP, b'WIFI DISCONNECT', timeout=1000, debug=debug)
         return ok
 
     def getConnection(self, debug=None):
         """Query current connection to an AP"""
-        response, ok = self._exec('AT+CWJAP_CUR?', b'OK', debug=debug)
-        return self._parseConnection(ok, response, '+CWJAP_CUR:', debug=debug)
+        response, ok = self._exec(_CMD_CWJAP_CUR_Q, b'OK', debug=debug)
+        return self._parseConnection(ok, response, _CWJAP_CUR, debug=debug)
 
     def getDefaultConnection(self, debug=None):
         """Query default connection to an AP"""
-        response, ok = self._exec('AT+CWJAP_DEF?', b'OK', debug=debug)
-        return self._parseConnection(ok, response, '+CWJAP_DEF:', debug=debug)
+        response, ok = self._exec(_CMD_CWJAP_DEF_Q, b'OK', debug=debug)
+        return self._parseConnection(ok, response, _CWJAP_DEF, debug=debug)
 
     def _parseConnection(self, ok, response, q, debug=None):
         if (not ok):
             return False
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8')
-                if (line.find('No AP') > -1):
-                    return False
-                if (line.find(q) == 0):
-                    conn = line.replace('\r', '').replace('\n', '').split(":", 1)[1]
-                    details = conn.split(",")
+        for line in response:
+            if (b'No AP' in line):
+                return False
+            elif (line.startswith(q)):
+                m = _CWJAP_RE.match(line.decode('utf-8'))
+                if m:
                     return {
-                        "ssid": details[0],
-                        "bssid": details[1],
-                        "channel": int(details[2]),
-                        "rssi": int(details[3])
+                        "ssid": m.group(2),
+                        "bssid": m.group(3),
+                        "channel": int(m.group(4)),
+                        "rssi": int(m.group(5))
                     }
 
-    def scan(self, timeout=15000, debug=None):
-        """Lists Available APs"""
+    def scan(self, timeout=15000, min_rssi=-95, dedup=True, max_age_ms=30000, force=False, debug=None):
+        """Lists Available APs, strongest first
+        APs weaker than min_rssi are dropped. With dedup only the strongest AP of each SSID
+        (e.g. mesh networks) is kept and hidden networks are skipped.
+        A result not older than max_age_ms is returned without scanning again,
+        pass force=True to get fresh results. Every call returns its own copy of the list and its entries.
+        """
         if (debug is None):
             debug = self.debug
+        if (not force and self._scan_cache and self._scan_cache_args == (min_rssi, dedup)
+                and ticks_diff(ticks_ms(), self._scan_cache_ts) < max_age_ms):
+            return [dict(ap) for ap in self._scan_cache]
         # set sort option (not working on my esp-01)
         # response, ok = self._exec('T+CWLAPOPT=0,15')
-        response, ok = self._exec('AT+CWLAP', b'OK', timeout=timeout, debug=debug)
-        aps = self._parseApList(response)
+        response, ok = self._exec(_CMD_CWLAP, b'OK', timeout=timeout, debug=debug)
+        aps = self._parseApList(response, min_rssi, dedup)
         if debug:
             print(aps)
         if aps:
-            aps.sort(key=lambda item: item.get("rssi"), reverse=True)
+            aps.sort(key=_apRssi, reverse=True)
+            if (ok):
+                self._scan_cache = [dict(ap) for ap in aps]
+                self._scan_cache_ts = ticks_ms()
+                self._scan_cache_args = (min_rssi, dedup)
 
         return aps
 
-    def _parseApList(self, apList):
-        # Authentication modes reported from scan in field 'ecn'
-        ECNs = {0: "open", 1: "WEP", 2: "WPA-PSK", 3: "WPA2-PSK", 4: "WPA/WPA2-PSK"}
-
+    def _parseApList(self, apList, min_rssi=None, dedup=False):
         if (apList is None):
             return None
 
         aps = []
+        # SSID -> index in aps of the strongest AP seen so far
+        seen = {}
         # [b'+CWLAP:(4,"one",-82,"22:11:33:44:55:66",1,-27,0)\r\n', b'+CWLAP:(4,"another",-33,"00:aa:bb:cc:dd:ee",1,-27,0)\r\n']
         for ap in apList:
             try:
-                ap = ap.decode('utf-8')
-                ap = ap.rstrip().split('+CWLAP:')[1]
-                # '(4,"one",-84,"22:11:33:44:55:66",1,-27,0)'
-                decoded = {}
-                # eval is evil!
-                ap = eval(ap)
-                # (4, 'one', -84, '22:11:33:44:55:66', 1, -27, 0)
-                if (len(ap) >= 3):
-                    ecn = int(ap[0])
-                    decoded = {
-                        'ecn': ecn,
-                        'auth_mode': ECNs[ecn], # UX friendly
-                        'ssid': ap[1],
-                        'rssi': int(ap[2])
-                    }
+                ap = self._parseCwlap(ap)
+                # [4, 'one', -84, '22:11:33:44:55:66', 1, -27, 0]
+                if (len(ap) < 3):
+                    continue
+                ssid = ap[1]
+                rssi = int(ap[2])
+                if (min_rssi is not None and rssi < min_rssi):
+                    continue
+                if (dedup):
+                    if (not ssid):
+                        continue
+                    if (ssid in seen and aps[seen[ssid]]['rssi'] >= rssi):
+                        continue
+                ecn = int(ap[0])
+                decoded = {
+                    'ecn': ecn,
+                    'auth_mode': _ECNS[ecn] if 0 <= ecn < len(_ECNS) else "unknown", # UX friendly
+                    'ssid': ssid,
+                    'rssi': rssi
+                }
                 if (len(ap) >= 4):
                     decoded['mac'] = ap[3]
                 if (len(ap) >= 5):
                     decoded['channel'] = ap[4]
 
-                aps.append(decoded)
+                if (dedup and ssid in seen):
+                    aps[seen[ssid]] = decoded
+                else:
+                    seen[ssid] = len(aps)
+                    aps.append(decoded)
             except Exception: # IndexError:
                 # The AP line in scan is malformatted
                 continue
 
         return aps
 
+    def _parseCwlap(self, line):
+        """Splits a single +CWLAP:(...) line into a list of fields (str or int)"""
+        # b'+CWLAP:(4,"one",-84,"22:11:33:44:55:66",1,-27,0)\r\n'
+        i = line.find(b'(') + 1
+        end = line.rfind(b')')
+        if (i == 0 or end < i):
+            raise ValueError('Malformed AP line')
+
+        fields = []
+        while i < end:
+            if line[i] == 0x22: # '"' opens a quoted string
+                i += 1
+                value = bytearray()
+                while i < end and line[i] != 0x22:
+                    if line[i] == 0x5c: # '\' escapes the next character
+                        i += 1
+                    value.append(line[i])
+                    i += 1
+                fields.append(bytes(value).decode('utf-8'))
+                # skip the closing quote and the following comma
+                i += 2
+            else:
+                j = line.find(b',', i, end)
+                if (j < 0):
+                    j = end
+                fields.append(int(line[i:j]))
+                i = j + 1
+
+        return fields
+
     def getApMac(self, debug=None):
         """Query the MAC address of the ESP8266 SoftAP"""
-        response, ok = self._exec('AT+CIPAPMAC_CUR?', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_CIPAPMAC_CUR_Q, b'OK', debug=debug)
         if (not ok):
             return None
 
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8').replace('\r', '').replace('\n', '')
-                if (line.find('+CIPAPMAC_CUR:') == 0):
-                    return line.split(':', 1)[1]
+        for line in response:
+            if (line.startswith(_CIPAPMAC_CUR)):
+                return line[len(_CIPAPMAC_CUR):].rstrip().decode('utf-8')
 
 
     def getStationMac(self, debug=None):
         """Query the MAC address of the ESP8266 station"""
-        response, ok = self._exec('AT+CIPSTAMAC_CUR?', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_CIPSTAMAC_CUR_Q, b'OK', debug=debug)
         if (not ok):
             return None
 
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8').replace('\r', '').replace('\n', '')
-                if (line.find('+CIPSTAMAC_CUR:') == 0):
-                    return line.split(':', 1)[1]
+        for line in response:
+            if (line.startswith(_CIPSTAMAC_CUR)):
+                return line[len(_CIPSTAMAC_CUR):].rstrip().decode('utf-8')
 
     def getApIp(self, debug=None):
         """Query the IP address of the ESP8266 SoftAP"""
-        response, ok = self._exec('AT+CIPAP_CUR?', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_CIPAP_CUR_Q, b'OK', debug=debug)
         if (not ok):
             return None
         # print(response) # [b'+CIPAP_CUR:ip:"192.168.4.1"\r\n', b'+CIPAP_CUR:gateway:"192.168.4.1"\r\n', b'+CIPAP_CUR:netmask:"255.255.255.0"\r\n', b'\r\n']
@@ -251,15 +366,14 @@ class ESP8266:
         gateway = None
         netmask = None
 
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8').replace('"', '').replace('\r', '').replace('\n', '')
-                if (line.find('+CIPAP_CUR:ip:') == 0):
-                    ip = line.split(":", 2)[2]
-                if (line.find('+CIPAP_CUR:gateway:') == 0):
-                    gateway = line.split(":", 2)[2]
-                if (line.find('+CIPAP_CUR:netmask:') == 0):
-                    netmask = line.split(":", 2)[2]
+        for line in response:
+            line = line.rstrip()
+            if (line.startswith(_CIPAP_CUR_IP)):
+                ip = line[len(_CIPAP_CUR_IP):-1].decode('utf-8')
+            elif (line.startswith(_CIPAP_CUR_GATEWAY)):
+                gateway = line[len(_CIPAP_CUR_GATEWAY):-1].decode('utf-8')
+            elif (line.startswith(_CIPAP_CUR_NETMASK)):
+                netmask = line[len(_CIPAP_CUR_NETMASK):-1].decode('utf-8')
 
         if (ip is None):
             return None
@@ -273,7 +387,7 @@ class ESP8266:
 
     def getStationIp(self, debug=None):
         """Query the IP address of the ESP8266 station"""
-        result, ok = self._exec('AT+CIPSTA_CUR?', b'OK', debug=debug)
+        result, ok = self._exec(_CMD_CIPSTA_CUR_Q, b'OK', debug=debug)
         if (not ok):
             return None
 
@@ -281,15 +395,14 @@ class ESP8266:
         ip = None
         gateway = None
         netmask = None
-        if (type(result) is list):
-            for line in result:
-                line = line.decode('utf-8').replace('"', '').replace('\r', '').replace('\n', '')
-                if (line.find('+CIPSTA_CUR:ip:') == 0):
-                    ip = line.split(":", 2)[2]
-                if (line.find('+CIPSTA_CUR:gateway:') == 0):
-                    gateway = line.split(":", 2)[2]
-                if (line.find('+CIPSTA_CUR:netmask:') == 0):
-                    netmask = line.split(":", 2)[2]
+        for line in result:
+            line = line.rstrip()
+            if (line.startswith(_CIPSTA_CUR_IP)):
+                ip = line[len(_CIPSTA_CUR_IP):-1].decode('utf-8')
+            elif (line.startswith(_CIPSTA_CUR_GATEWAY)):
+                gateway = line[len(_CIPSTA_CUR_GATEWAY):-1].decode('utf-8')
+            elif (line.startswith(_CIPSTA_CUR_NETMASK)):
+                netmask = line[len(_CIPSTA_CUR_NETMASK):-1].decode('utf-8')
 
         if (ip is None):
             return None
@@ -302,45 +415,39 @@ class ESP8266:
 
     def getApConfig(self, debug=None):
         """Gets configuration for the ESP8266 SoftAP"""
-        response, ok = self._exec('AT+CWSAP_CUR?', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_CWSAP_CUR_Q, b'OK', debug=debug)
         # +CWSAP_CUR:<ssid>,<pwd>,<chl>,<ecn>,<max conn>,<ssid hidden>
         if (not ok):
             return None
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8')
-                if (line.find("+CWSAP_CUR:") == 0):
-                    config = line.replace('\r', '').replace('\n', '').split(":", 1)[1]
-                    details = config.split(",")
-                    return {
-                        "ssid": details[0],
-                        "password": details[1],
-                        "channel": int(details[2]),
-                        "ecn": int(details[3]),
-                        "max_conn": int(details[4]),
-                        "hidden": bool(details[5])
-                    }
+        for line in response:
+            if (line.startswith(_CWSAP_CUR)):
+                details = line[len(_CWSAP_CUR):].rstrip().decode('utf-8').split(",")
+                return {
+                    "ssid": details[0],
+                    "password": details[1],
+                    "channel": int(details[2]),
+                    "ecn": int(details[3]),
+                    "max_conn": int(details[4]),
+                    "hidden": bool(details[5])
+                }
 
     def getDefaultApConfig(self, debug=None):
         """Gets configuration for the ESP8266 SoftAP"""
-        response, ok = self._exec('AT+CWSAP_DEF?', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_CWSAP_DEF_Q, b'OK', debug=debug)
         # +CWSAP_DEF:<ssid>,<pwd>,<chl>,<ecn>,<max conn>,<ssid hidden>
         if (not ok):
             return None
-        if (type(response) is list):
-            for line in response:
-                line = line.decode('utf-8')
-                if (line.find("+CWSAP_DEF:") == 0):
-                    config = line.replace('\r', '').replace('\n', '').split(":", 1)[1]
-                    details = config.split(",")
-                    return {
-                        "ssid": details[0],
-                        "password": details[1],
-                        "channel": int(details[2]),
-                        "ecn": int(details[3]),
-                        "max_conn": int(details[4]),
-                        "hidden": not bool(details[5])
-                    }
+        for line in response:
+            if (line.startswith(_CWSAP_DEF)):
+                details = line[len(_CWSAP_DEF):].rstrip().decode('utf-8').split(",")
+                return {
+                    "ssid": details[0],
+                    "password": details[1],
+                    "channel": int(details[2]),
+                    "ecn": int(details[3]),
+                    "max_conn": int(details[4]),
+                    "hidden": not bool(details[5])
+                }
 
     def setApConfig(self, ssid, password, channel, ecn=4, max_conn=4, hidden=0, debug=None):
         """Configures the ESP8266 SoftAP; Configuration Not Saved in the Flash"""
@@ -353,22 +460,27 @@ class ESP8266:
         return ok
 
     def startServer(self, port=80, maxAllowedConnections=1, tcpTimeout=30, debug=None):
-        if (1 > maxAllowedConnections > 5):
-            raise Exception('Max Allowed TCP Connection must be between 1 and 5')
-        if (0 > tcpTimeout > 7200):
-            raise Exception('Max TCP Timeout must be between 0 and 7200 seconds')
-        # A TCP server can only be created when multiple connections are activated (AT+CIPMUX=1)
-        self._exec('AT+CIPMUX=1', b'OK', debug=debug)
+        if not (1 <= maxAllowedConnections <= 5):
+            raise ValueError('Max Allowed TCP Connection must be between 1 and 5')
+        if not (0 <= tcpTimeout <= 7200):
+            raise ValueError('Max TCP Timeout must be between 0 and 7200 seconds')
+        # A TCP server can only be created when multiple connections are activated (AT+CIPMUX=1).
+        # This and the next command answer ERROR while a server or a connection is already up,
+        # so their results are not part of the one reported.
+        self._exec(b'AT+CIPMUX=1', b'OK', debug=debug)
         # Set the Maximum Connections Allowed by Server - in this case we want 1
-        self._exec('AT+CIPSERVERMAXCONN='+str(maxAllowedConnections), b'OK', debug=debug)
-        # Start the server on requested port
-        response, ok = self._exec('AT+CIPSERVER=1,'+str(port), b'OK', debug=debug)
-        # Sets the TCP Server Timeout - in this case we need 30 s
-        self._exec('AT+CIPSTO='+str(tcpTimeout), b'OK', debug=debug)
+        self._exec(b'AT+CIPSERVERMAXCONN=%d' % maxAllowedConnections, b'OK', debug=debug)
+        # Returns True if the server is started and its timeout set
+        response, ok = self._execBatch([
+            # Start the server on requested port
+            b'AT+CIPSERVER=1,%d' % port,
+            # Sets the TCP Server Timeout - in this case we need 30 s
+            b'AT+CIPSTO=%d' % tcpTimeout
+        ], debug=debug)
         return ok
 
     def stopServer(self, debug=None):
-        response, ok = self._exec('AT+CIPSERVER=0', b'OK', debug=debug)
+        response, ok = self._exec(_CMD_CIPSERVER_STOP, b'OK', debug=debug)
         return ok
 
     #
@@ -377,22 +489,22 @@ class ESP8266:
     def ping(self, destination, debug=None):
         """Ping the destination address or hostname"""
         """Returns the response time or None if the ping is unsuccessful"""
-        result, ok = self._exec('AT+PING='+self._joinArgs(destination), b'OK', debug=debug)
+        result, ok = self._exec('AT+PING="%s"' % destination, b'OK', debug=debug)
         if (debug):
             print(result)
 
-        if (type(result) is list):
-            for line in result:
-                line = line.decode('utf-8').replace('\r', '').replace('\n', '')
-                if (line.find('ERR') > -1):
-                    return None
-                if (line.find('+timeout') > -1):
-                    return None
-                if (line.find('+') == 0):
-                    # the response time of ping
-                    return int(line.replace('+', ''))
+        for line in result:
+            if (b'ERR' in line or b'+timeout' in line):
+                return None
+            elif (line.startswith(b'+')):
+                # the response time of ping
+                return int(line[1:])
 
     def httpRequest(self, method, url, data=None, headers=[], user_agent="ESP-01 (on RPi Pico)", timeout=10000, debug=None):
+        """Sends an HTTP request
+        Returns a tuple (status code, list of header lines, body) or None if the request could not be sent.
+        Header lines are bytes and the body is a memoryview (bytes(body).decode() for text).
+        """
         if method not in ["HEAD", "GET", "POST", "PUT", "DELETE"]:
             raise Exception('Unknown HTTP method ' + method)
 
@@ -428,35 +540,52 @@ class ESP8266:
         if auth:
             auth = str(base64enc(auth)).replace("b'", "").replace("\\n'", "")
             header += f"Authorization: Basic {auth}\r\n"
+        if data:
+            if not isinstance(data, (bytes, bytearray)):
+                data = data.encode()
+            header += "Content-Length: " + str(len(data)) + "\r\n"
         header += "\r\n"
         if (debug):
         #    print('Connection to', host, 'ESTABLISHED')
             print('Requesting:')
             print(header)
-        result, ok = self._exec("AT+CIPSEND="+str(len(header)), b'OK')
-        result, ok = self._exec(header, b'SEND OK', timeout=timeout)
+        header = header.encode()
+        result, ok = self._exec(b'AT+CIPSEND=%d' % (len(header) + (len(data) if data else 0)), b'OK')
+        # header and body are written one after another, without building a copy of both
+        if (not self._writeAll(header, timeout=timeout) or (data and not self._writeAll(data, timeout=timeout))):
+            # the module still waits for the rest of the announced bytes, drop the connection
+            if (debug):
+                print('sending request failed')
+            self.closeConnection(debug=debug)
+            return None
+        result, ok = self._exec(None, b'SEND OK', timeout=timeout)
         if (debug):
             print(result)
 
-        _, data = self.receiveData(debug=debug)
+        _, response = self._receive(debug=debug)
         #self.closeConnection(debug=debug)
 
-        return data
+        return self._parseHttpResponse(response)
 
     def _parseHttpResponse(self, response):
-        if (response is None):
-            return 0, None
+        """Splits a raw HTTP response into status code, header lines (bytes) and body (memoryview)"""
+        if not response:
+            return 0, [], memoryview(b'')
 
-        data = ""
-        headers = []
-        code = 0
+        end = response.find(b'\r\n\r\n')
+        if (end < 0):
+            end = len(response)
+        headers = response[:end].split(b'\r\n')
+        body = memoryview(response)[end + 4:]
 
-        if data:
-            data = data.split("\r\n\r\n")
-            headers = data[0].split('\r\n')
-            data = data[1]
+        # HTTP/1.1 200 OK
+        code = 0
+        try:
+            code = int(headers.pop(0).split(None, 2)[1])
+        except (IndexError, ValueError):
+            pass
 
-        return code, headers, data
+        return code, headers, body
 
     def startConnection(self, transportType, link, port=80, debug=None):
         """Establishes TCP/SSL Connection"""
@@ -464,97 +593,201 @@ class ESP8266:
             raise Exception('Invalid Transport Type')
 
         # self._exec("AT+CIPMUX=0")
-        args = self._joinArgs(transportType, link, port)
-        # print('AT+CIPSTART=' + args)
-        result, ok = self._exec('AT+CIPSTART=' + args, b'OK', timeout=5000, debug=debug)
+        result, ok = self._exec('AT+CIPSTART="%s","%s",%d' % (transportType, link, port), b'OK', timeout=5000, debug=debug)
 
         # if ok == False does not mean that there is no connection
         # check for ERROR and CONNECT (ALREADY CONNECTED)
-        if (type(result) is list):
-            for line in result:
-                line = line.decode('utf-8').replace('\r', '').replace('\n', '')
-                if (line.find('ERR') > -1):
-                    return False
-                if (line.find('CONN') > -1):
-                    return True
-                if (line.find('OK') > -1):
-                    return True
+        for line in result:
+            if (b'ERR' in line):
+                return False
+            elif (b'CONN' in line or b'OK' in line):
+                return True
 
         return ok
 
     def closeConnection(self, debug=None):
         """Closes Connection"""
-        result, ok = self._exec('AT+CIPCLOSE', b'OK', debug=debug)
+        result, ok = self._exec(_CMD_CIPCLOSE, b'OK', debug=debug)
 
         return True
 
     def receiveData(self, debug=None):
+        ID, payload = self._receive(debug=debug)
+        if (payload is None):
+            return None, None
+        return ID, payload.decode()
+
+    def _receive(self, debug=None):
+        """Reads +IPD data; returns the connection ID and the raw payload"""
         if (debug is None):
             debug = self.debug
 
-        data = self.uart.read()
-        if (data != None):
-            data = data.decode()
-            if debug:
-                print(data)
-            if (data.find('+IPD') >= 0):
-                n1 = data.find('+IPD,')
-                n2 = data.find(':',n1+5)
-                ID = int(data[n1+5:n2])
-                n3 = data.find(':')
-                data = data[n3+1:]
-                if data.endswith('CLOSED'):
-                    data = data[:-6]
-                return ID, data
-        return None, None
+        raw = self.uart.read()
+        if (self._rxlen):
+            raw = bytes(self._rxview[:self._rxlen]) + (raw or b'')
+            self._rxlen = 0
+        if (raw is None):
+            return None, None
+        if debug:
+            print(raw)
+
+        # +IPD,<id>,<len>:<data> (or +IPD,<len>:<data> for a single connection)
+        i = raw.find(b'+IPD,')
+        if (i < 0):
+            return None, None
+        j = raw.find(b':', i + 5)
+        if (j < 0):
+            return None, None
+        k = raw.find(b',', i + 5, j)
+        ID = int(raw[i + 5:(j if k < 0 else k)])
+        if raw.endswith(b'CLOSED'):
+            return ID, raw[j + 1:-6]
+        return ID, raw[j + 1:]
 
     def sendResponse(self, connId, data, statusCode=200, debug=None):
+        """Sends an HTTP response and closes the connection
+        Returns False if the response could not be written completely
+        """
         if (debug is None):
             debug = self.debug
 
-        cnt = len(data)
-        data = "HTTP/1.1 {} OK\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n".format(statusCode) + data
-        result, ok = self._exec('AT+CIPSEND='+str(connId)+','+str(cnt), b'OK')
-        self.uart.write(data)
+        header = b'HTTP/1.1 %d OK\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n' % statusCode
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode()
+        cnt = len(header) + len(data)
+        result, ok = self._exec(b'AT+CIPSEND=%d,%d' % (connId, cnt), b'OK')
+        # header and body are written one after another, without building a copy of both
+        sent = self._writeAll(header) and self._writeAll(data)
         if (debug):
+            print(header)
             print(data)
+            if (not sent):
+                print('sending response failed')
         self.closeConnection(debug=debug)
+        return sent
 
     def _exec(self, cmd, acc=None, timeout=2000, debug=None):
-        DELTA_WAIT = 100 # the time in milliseconds before checking the result
+        """Sends cmd (if not None) and collects the response lines until acc or timeout"""
         if (debug is None):
             debug = self.debug
 
         result = []
         ok = False
-        if (debug):
-            print ('<', cmd)
-        cmd += '\r\n' # AT commands must end with a new line (CR LF)
-        self.uart.write(cmd)
+        if (cmd is not None):
+            if (debug):
+                print ('<', cmd)
+            if isinstance(cmd, str):
+                cmd = cmd.encode()
+            self.uart.write(cmd)
+            # AT commands must end with a new line (CR LF)
+            self.uart.write(b'\r\n')
+
+        # pos - end of the received data, start - beginning of the line not yet processed
+        pos = self._rxlen
+        start = 0
+        self._rxlen = 0
 
         # wait no more then a maximum timeout given (in milliseconds) for a command reaction
-        ticks = int(timeout / DELTA_WAIT)
-        if (ticks < 1):
-            ticks = 1
-        while ticks > 0:
-            if self.uart.any():
-                line = self.uart.readline()
-                if not line:
-                    continue
-                if (debug):
-                    print('>',line)
-                if line.rstrip() == b'OK':
-                    ok = True
-                if (acc and (line.rstrip() == acc)):
-                    return result, ok
-                else:
+        deadline = ticks_add(ticks_ms(), timeout)
+        # data left over from the previous command is processed before waiting for more
+        n = pos
+        while True:
+            if n:
+                # only the bytes just read are searched for the end of a line
+                fresh = pos - n
+                received = bytes(self._rxview[fresh:pos])
+                nl = received.find(b'\n')
+                while nl >= 0:
+                    end = fresh + nl + 1
+                    # a line is copied once, when it is complete
+                    line = bytes(self._rxview[start:end])
+                    start = end
+                    if (debug):
+                        print('>',line)
+                    stripped = line.rstrip()
+                    if stripped == b'OK':
+                        ok = True
+                    if (acc and (stripped == acc)):
+                        # keep whatever came after the awaited line for the next read
+                        self._keepRest(start, pos)
+                        return result, ok
                     result.append(line)
-            else:
-                sleep_ms(DELTA_WAIT)
-            ticks -= 1
+                    if stripped == b'ERROR':
+                        # the command failed, nothing more will come for it
+                        self._keepRest(start, pos)
+                        return result, ok
+                    nl = received.find(b'\n', nl + 1)
+
+            remaining = ticks_diff(deadline, ticks_ms())
+            if remaining <= 0 or not self._poll.poll(remaining):
+                break
+            n = self.uart.any()
+            if n:
+                if (pos == len(self._rxbuf)):
+                    pos, start = self._makeRoom(pos, start)
+                n = self.uart.readinto(self._rxview[pos:], min(n, len(self._rxbuf) - pos))
+                if n:
+                    pos += n
+
+        if (start < pos):
+            # an incomplete line received before the timeout
+            result.append(bytes(self._rxview[start:pos]))
 
         return result, ok
 
+    def _writeAll(self, data, timeout=5000):
+        """Writes data in chunks, waiting for room in the UART TX buffer when it is full
+        Returns False if not everything could be written within the timeout.
+        """
+        mv = memoryview(data)
+        deadline = ticks_add(ticks_ms(), timeout)
+        while len(mv):
+            chunk = mv[:_TX_CHUNK]
+            n = self.uart.write(chunk) or 0
+            mv = mv[n:]
+            if (n < len(chunk)):
+                remaining = ticks_diff(deadline, ticks_ms())
+                if remaining <= 0 or not self._poll_out.poll(remaining):
+                    return False
+
+        return True
+
+    def _execBatch(self, cmds, timeout=5000, debug=None):
+        """Executes several commands within a single timeout
+        Returns all the response lines and True if every command was acknowledged with OK.
+        The ESP8266 answers "busy p..." to a command sent while it is still processing the previous one,
+        so each command is written as soon as the previous OK is received.
+        Stops at the first command that is not acknowledged; the rest are not sent.
+        """
+        deadline = ticks_add(ticks_ms(), timeout)
+        result = []
+        for cmd in cmds:
+            remaining = ticks_diff(deadline, ticks_ms())
+            if (remaining <= 0):
+                return result, False
+            response, ok = self._exec(cmd, b'OK', timeout=remaining, debug=debug)
+            result.extend(response)
+            if (not ok):
+                return result, False
+
+        return result, True
+
+    def _keepRest(self, start, pos):
+        """Moves the unprocessed received bytes to the beginning of the buffer for the next read"""
+        self._rxlen = pos - start
+        self._rxbuf[:self._rxlen] = self._rxbuf[start:pos]
+
+    def _makeRoom(self, pos, start):
+        """Frees space at the end of the receive buffer, growing it if all of it is unprocessed"""
+        if (start > 0):
+            self._rxbuf[:pos - start] = self._rxbuf[start:pos]
+            return pos - start, 0
+        buf = bytearray(len(self._rxbuf) * 2)
+        buf[:pos] = self._rxbuf
+        self._rxbuf = buf
+        self._rxview = memoryview(buf)
+        return pos, start
+
     def _joinArgs(self, *args):
         result = []
         for arg in args:
@@ -570,7 +803,9 @@ class ESP8266:
                 result.append(str(arg))
         return ','.join(result)
 
-from utime import ticks_ms
+def _apRssi(ap):
+    """Sort key for scanned APs"""
+    return ap['rssi']
 
 class UartTimeOut(UART):
     """
@@ -580,19 +815,27 @@ class UartTimeOut(UART):
     Thanks to Roger
     https://github.com/myvobot/pi_pico_wifi_driver/blob/main/uart_timeout_any.py
     """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._poller = uselect.poll()
+        self._poller.register(self, uselect.POLLIN)
+
     def readline(self, timeOut=100):
        if timeOut is None:
            return super().readline()
        else:
            now = ticks_ms()
-           data = b''
+           data = bytearray()
            while True:
-               if ticks_ms()-now > timeOut:
+               remaining = timeOut - ticks_diff(ticks_ms(), now)
+               # sleep until some bytes arrive instead of spinning on any()
+               if remaining <= 0 or not self._poller.poll(remaining):
                    break
-               else:
-                   if super().any():
-                       _d = super().read(1)
-                       data += _d
-                       if "\n" in _d:
-                           break
-           return data
+               # take what is received, but nothing past the new line: it stays in the UART for
+               # any(), read() and the pollers
+               while super().any():
+                   _d = super().read(1)
+                   data.extend(_d)
+                   if _d == b'\n':
+                       return bytes(data)
+           return bytes(data)